@@ -0,0 +1,46 @@
+"""
+    Copyright 2018 Inmanta
+    Contact: code@inmanta.com
+    License: Apache 2.0
+"""
+
+basemodel = """
+import testmodule
+
+r = testmodule::Resource(agent="a", name="IT", key="k", value="write")
+"""
+
+
+def test_cache_hit(project):
+    project.compile(basemodel)
+    types = project.types
+
+    project.compile(basemodel)
+    assert project.types is types
+
+
+def test_cache_miss_on_mock_file(project):
+    project.add_mock_file("templates", "test.tmpl", "a")
+    project.compile(basemodel)
+    types = project.types
+
+    project.add_mock_file("templates", "test.tmpl", "bb")
+    project.compile(basemodel)
+    assert project.types is not types
+
+
+def test_cache_miss_on_fact(project):
+    project.compile(basemodel)
+    types = project.types
+
+    project.add_fact(project.get_resource("testmodule::Resource").id.resource_str(), "fact", "value")
+    project.compile(basemodel)
+    assert project.types is not types
+
+
+def test_change_resource(project):
+    project.compile(basemodel)
+    project.get_resource("testmodule::Resource").value = "changed"
+
+    project.compile(basemodel)
+    assert project.get_resource("testmodule::Resource").value == "write"
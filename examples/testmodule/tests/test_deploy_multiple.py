@@ -0,0 +1,23 @@
+"""
+    Copyright 2018 Inmanta
+    Contact: code@inmanta.com
+    License: Apache 2.0
+"""
+
+
+def test_deploy_multiple(project):
+    basemodel = """
+    import testmodule
+
+    r1 = testmodule::Resource(agent="a", name="r1", key="k", value="write")
+    r2 = testmodule::Resource(agent="a", name="r2", key="k", value="write")
+    """
+
+    project.compile(basemodel)
+
+    project.deploy_resource("testmodule::Resource", name="r1")
+    project.deploy_resource("testmodule::Resource", name="r2")
+
+    assert project.dryrun_resource("testmodule::Resource", name="r2") == {
+        "value": {'current': 'read', 'desired': 'write'}
+    }
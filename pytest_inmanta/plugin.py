@@ -15,39 +15,55 @@
 
     Contact: code@inmanta.com
 """
-import tempfile
 import os
 import shutil
 import sys
 import io
 import logging
-import imp
 import glob
-import importlib
+import importlib.util
 import types
-from distutils import dir_util
-
-
-from inmanta import compiler
-from inmanta import module
-from inmanta import export
+import hashlib
+import functools
+import weakref
+import copy
+import contextlib
+import warnings
+import typing
+from pathlib import Path
+
+
+# the compiler, agent, protocol and tornado modules are imported where they are used, to keep the import of this plugin
+# (and with it every pytest invocation) cheap
 from inmanta import config
 from inmanta import const
-from inmanta.agent import cache
-from inmanta.agent import handler
-from inmanta.agent import io as agent_io
-from inmanta.execute.proxy import DynamicProxy
 
 import pytest
 from collections import defaultdict
-import yaml
-from inmanta.protocol import json_encode
-from tornado import ioloop
+
+if typing.TYPE_CHECKING:
+    from inmanta.agent import handler
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    # not available on windows
+    fcntl = None
 
 
 CURDIR = os.getcwd()
 LOGGER = logging.getLogger()
 
+# Result of the last compile, keyed on the model and the state of the modules in the project. See Project.compile
+_COMPILE_CACHE = {}
+
+_MISSING = object()
+
 
 option_to_env = {
     "inm_venv":"INMANTA_TEST_ENV",
@@ -62,6 +78,8 @@ def pytest_addoption(parser):
                     help='folder in which to place the virtual env for tests (will be shared by all tests), overrides INMANTA_TEST_ENV')
     group.addoption('--module_repo', dest='inm_module_repo',
                     help='location to download modules from, overrides INMANTA_MODULE_REPO')
+    group.addoption('--compile_cache', dest='inm_compile_cache', action='store_true', default=False,
+                    help='reuse the result of the previous compile when the same model is compiled again')
 
 
 def get_opt_or_env_or(config, key, default):
@@ -73,42 +91,203 @@ def get_opt_or_env_or(config, key, default):
 
 
 def get_module_info():
-    curdir = CURDIR
-    # Make sure that we are executed in a module
-    dir_path = curdir.split(os.path.sep)
-    while not os.path.exists(os.path.join(os.path.join("/", *dir_path), "module.yml")) and len(dir_path) > 0:
-        dir_path.pop()
+    return _get_module_info(CURDIR)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_module_info(curdir):
+    import yaml
 
-    if len(dir_path) == 0:
+    # Make sure that we are executed in a module
+    path = Path(curdir)
+    for module_dir in [path, *path.parents]:
+        module_yml = module_dir / "module.yml"
+        if module_yml.is_file():
+            break
+    else:
         raise Exception("Module test case have to be saved in the module they are intended for. "
                         "%s not part of module path" % curdir)
 
-    module_dir = os.path.join("/", *dir_path)
-    with open("module.yml") as m:
-        module_name = yaml.load(m)["name"]
+    with module_yml.open() as m:
+        module_name = yaml.safe_load(m)["name"]
+
+    return str(module_dir), module_name
+
 
-    return module_dir, module_name
+def _link_tree(src, dst):
+    """
+        Recreate the directory tree of src in dst, hard linking the files. Files that cannot be linked, for example because
+        dst is on another filesystem, are copied. Symlinks are recreated as symlinks, they are not followed. When dst is
+        inside src, it is skipped.
+    """
+    dst_real = os.path.realpath(dst)
+    for dir_path, dir_names, file_names in os.walk(src):
+        target_dir = os.path.join(dst, os.path.relpath(dir_path, src))
+        os.makedirs(target_dir, exist_ok=True)
+
+        for dir_name in list(dir_names):
+            source = os.path.join(dir_path, dir_name)
+            if os.path.realpath(source) == dst_real:
+                dir_names.remove(dir_name)
+            elif os.path.islink(source):
+                _copy_symlink(source, os.path.join(target_dir, dir_name))
+
+        for file_name in file_names:
+            source = os.path.join(dir_path, file_name)
+            target = os.path.join(target_dir, file_name)
+            if os.path.islink(source):
+                _copy_symlink(source, target)
+                continue
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copy2(source, target)
+
+
+def _copy_symlink(source, target):
+    try:
+        os.symlink(os.readlink(source), target, target_is_directory=os.path.isdir(source))
+    except OSError:
+        LOGGER.warning("Unable to recreate symlink %s as %s, it is left out of the test project.", source, target)
+
+
+def _import_source(name, path, submodule_search_locations=None):
+    """
+        Import the python file at path as the module name. The bytecode is cached in __pycache__ like for regular imports.
+    """
+    spec = importlib.util.spec_from_file_location(name, path, submodule_search_locations=submodule_search_locations)
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[name] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+
+@functools.lru_cache(maxsize=None)
+def _load_plugins(module_dir, mtime_ns):
+    """
+        Import the plugins of the module in module_dir and return all functions defined in them, by name. mtime_ns is the
+        most recent modification time of the plugin files, it invalidates the cache when a plugin changes.
+    """
+    plugin_dir = os.path.join(module_dir, "plugins")
+    package_name = "inmanta_plugins." + os.path.basename(module_dir)
+    package = _import_source(package_name, os.path.join(plugin_dir, "__init__.py"), [plugin_dir])
+
+    with os.scandir(plugin_dir) as entries:
+        py_files = sorted(
+            entry.path for entry in entries
+            if entry.is_file() and entry.name.endswith(".py") and entry.name != "__init__.py"
+        )
+
+    sub_mods = [package]
+    for py_file in py_files:
+        sub_mod_name = os.path.basename(py_file)[:-len(".py")]
+        sub_mods.append(_import_source(package_name + "." + sub_mod_name, py_file))
+
+    result = {}
+    for sub_mod in sub_mods:
+        for k, v in sub_mod.__dict__.items():
+            if isinstance(v, types.FunctionType):
+                result[k] = v
+    return result
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """
+        Hold an exclusive lock on the file at path, shared between processes. Nothing is locked when path is None or when
+        the platform has no fcntl.
+    """
+    if path is None or fcntl is None:
+        yield
+        return
+
+    while True:
+        fd = open(path, "a")
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        # the file can be removed while waiting for the lock (creating a venv clears its directory), then the lock is
+        # taken on the new file
+        try:
+            if os.path.samestat(os.fstat(fd.fileno()), os.stat(path)):
+                break
+        except FileNotFoundError:
+            pass
+        fd.close()
+
+    with fd:
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def _copy_resources(resources):
+    """
+        Copy the resources, so changes to them don't end up in the compile cache. Resource.clone() can't be used, it drops
+        the model reference that is_type needs.
+    """
+    result = {}
+    for key, resource in resources.items():
+        resource_copy = copy.copy(resource)
+        for name, value in vars(resource).items():
+            if name != "model":
+                resource_copy.__dict__[name] = copy.deepcopy(value)
+        result[key] = resource_copy
+    return result
+
+
+def _compile_cache_key(project_dir, main, facts):
+    """
+        Compute the key under which the result of compiling main in the given project is cached. The key covers the model,
+        the facts and the path and content of every source file of every module in the libs directory of the project.
+    """
+    digest = hashlib.sha256(main.encode())
+    digest.update(repr(sorted((str(k), sorted(v.items())) for k, v in facts.items())).encode())
+
+    libs_dir = os.path.join(project_dir, "libs")
+    for module_name in sorted(os.listdir(libs_dir)):
+        module_dir = os.path.join(libs_dir, module_name)
+        paths = [os.path.join(module_dir, "module.yml")]
+        for sub_dir in ["model", "plugins", "templates", "files"]:
+            for dir_path, dir_names, file_names in os.walk(os.path.join(module_dir, sub_dir)):
+                dir_names[:] = sorted(d for d in dir_names if d != "__pycache__")
+                paths.extend(os.path.join(dir_path, file_name) for file_name in sorted(file_names))
+
+        for path in paths:
+            try:
+                content = Path(path).read_bytes()
+            except FileNotFoundError:
+                continue
+            digest.update(("%s:%d;" % (path, len(content))).encode())
+            digest.update(content)
+
+    return digest.hexdigest()
 
 
 @pytest.fixture()
 def project(project_shared, capsys):
-    project_shared.init(capsys)
+    project_shared.reset(capsys)
     return project_shared
 
 
 @pytest.fixture(scope="session")
-def project_shared(request):
+def project_shared(request, tmp_path_factory):
     """
         A test fixture that creates a new inmanta project with the current module in. The returned object can be used
         to add files to the unittest module, compile a model and access the results, stdout and stderr.
+
+        Every pytest-xdist worker gets its own project. When the workers share a venv, they compile one at a time, because
+        a compile can install requirements in the venv.
     """
-    _sys_path = sys.path
-    test_project_dir = tempfile.mkdtemp()
-    os.mkdir(os.path.join(test_project_dir, "libs"))
+    _sys_path = list(sys.path)
+    _sys_modules = set(sys.modules)
+    worker_id = getattr(request.config, "workerinput", {}).get("workerid", "master")
 
     repos = get_opt_or_env_or(request.config, "inm_module_repo", "https://github.com/inmanta/").split(" ")
-
     env_override = get_opt_or_env_or(request.config, "inm_venv", None)
+
+    test_project_dir = str(tmp_path_factory.mktemp("inmanta_project_%s" % worker_id, numbered=True))
+    os.mkdir(os.path.join(test_project_dir, "libs"))
+
     if env_override is not None:
         try:
             os.symlink(env_override, os.path.join(test_project_dir, ".env"))
@@ -128,26 +307,36 @@ modulepath: libs
 downloadpath: libs
 """ % {"repo": "', '".join(repos)})
 
-    # copy the current module in
+    # link the current module in
     module_dir, module_name = get_module_info()
-    dir_util.copy_tree(module_dir, os.path.join(test_project_dir, "libs", module_name))
+    module_link = os.path.join(test_project_dir, "libs", module_name)
+    try:
+        os.symlink(module_dir, module_link, target_is_directory=True)
+    except OSError:
+        LOGGER.info("Unable to symlink %s to %s, falling back to a hard linked copy.", module_link, module_dir)
+        _link_tree(module_dir, module_link)
+
+    venv_lock = None
+    if env_override is not None and worker_id != "master":
+        os.makedirs(env_override, exist_ok=True)
+        venv_lock = os.path.join(env_override, ".pytest_inmanta.lock")
 
-    test_project = Project(test_project_dir)
+    test_project = Project(
+        test_project_dir, compile_cache=request.config.getoption("inm_compile_cache"), venv_lock=venv_lock
+    )
 
     # create the unittest module
     test_project.create_module("unittest")
 
     yield test_project
 
-    try:
-        shutil.rmtree(test_project_dir)
-    except PermissionError:
-        LOGGER.warning(
-            "Cannot cleanup test project %s. This can be caused because we try to remove a virtual environment, "
-            "loaded by this python process. Try to use a shared environment with --venv", test_project_dir
-        )
-
-    sys.path = _sys_path
+    # the project directory is removed by pytest, together with the other temporary directories of old sessions
+    sys.path[:] = _sys_path
+    for name in set(sys.modules) - _sys_modules:
+        if name == "inmanta_plugins" or name.startswith("inmanta_plugins."):
+            del sys.modules[name]
+    # the cached plugin functions belong to the modules that were just removed
+    _load_plugins.cache_clear()
 
 
 class MockProcess(object):
@@ -155,17 +344,21 @@ class MockProcess(object):
         A mock agentprocess
     """
 
-    def __init__(self):
-        self._io_loop = ioloop.IOLoop.current()
+    def __init__(self, io_loop=None):
+        if io_loop is None:
+            from tornado import ioloop
+
+            io_loop = ioloop.IOLoop.current()
+        self._io_loop = io_loop
 
 
 class MockAgent(object):
     """
         A mock agent for unit testing
     """
-    def __init__(self, uri):
+    def __init__(self, uri, io_loop=None):
         self.uri = uri
-        self.process = MockProcess()
+        self.process = MockProcess(io_loop)
 
 
 class Project():
@@ -174,29 +367,52 @@ class Project():
         modules from the provided repositories. Additional repositories can be provided by setting the INMANTA_MODULE_REPO
         environment variable. Repositories are separated with spaces.
     """
-    def __init__(self, project_dir):
+    _config_loaded = False
+
+    def __init__(self, project_dir, compile_cache=False, venv_lock=None):
         self._test_project_dir = project_dir
+        self._compile_cache = compile_cache
+        self._venv_lock = venv_lock
         self._stdout = None
         self._stderr = None
         self.types = None
         self.version = None
         self.resources = {}
+        self._resources_by_type = {}
         self._exporter = None
         self._blobs = {}
         self._facts = defaultdict(dict)
         self._plugins = self._load_plugins()
         self._capsys = None
-        config.Config.load_config()
+        # contexts whose logs were already checked, with the number of log lines at that time
+        self._finalized_contexts = weakref.WeakKeyDictionary()
+        self._load_config()
 
-    def init(self, capsys):
+    @classmethod
+    def _load_config(cls):
+        if not cls._config_loaded:
+            config.Config.load_config()
+            cls._config_loaded = True
+
+    def reset(self, capsys):
+        """
+            Clear the state of the previous test, the project directory and the loaded config are kept
+        """
         self._capsys = capsys
         self.types = None
         self.version = None
         self.resources = {}
+        self._resources_by_type = {}
         self._exporter = None
-        self._blobs = {}
-        self._facts = defaultdict(dict)
-        config.Config.load_config()
+        self._blobs.clear()
+        self._facts.clear()
+
+    def init(self, capsys):
+        """
+            Deprecated alias of reset
+        """
+        warnings.warn("Project.init is deprecated, use Project.reset instead", DeprecationWarning, stacklevel=2)
+        self.reset(capsys)
 
     def add_blob(self, key, content, allow_overwrite=True):
         """
@@ -215,32 +431,67 @@ class Project():
     def add_fact(self, resource_id, name, value):
         self._facts[resource_id][name] = value
 
-    def get_handler(self, resource, run_as_root):
+    def get_handler(self, resource, run_as_root, agent_cache=None):
+        """
+            Get a handler for the given resource. The version of the resource has to stay open in agent_cache for as long
+            as the handler is used. When no agent_cache is passed, a new one is created with the version left open.
+        """
+        from inmanta.agent import cache
+        from inmanta.agent import handler
+        from tornado import ioloop
+
+        if agent_cache is None:
+            agent_cache = cache.AgentCache()
+            agent_cache.open_version(resource.id.version)
+
+        # the loop can change between tests (e.g. a per test event loop), so it is looked up for every handler
+        io_loop = ioloop.IOLoop.current()
+
         # TODO: if user is root, do not use remoting
-        c = cache.AgentCache()
         if run_as_root:
-            agent = MockAgent("ssh://root@localhost")
+            agent = MockAgent("ssh://root@localhost", io_loop)
         else:
-            agent = MockAgent("local:")
+            agent = MockAgent("local:", io_loop)
 
-        c.open_version(resource.id.version)
-        try:
-            p = handler.Commander.get_provider(c, agent, resource)
-            p.set_cache(c)
-            p.get_file = lambda x: self.get_blob(x)
-            p.stat_file = lambda x: self.stat_blob(x)
-            p.upload_file = lambda x, y: self.add_blob(x, y)
-            p.run_sync = ioloop.IOLoop.current().run_sync
+        p = handler.Commander.get_provider(agent_cache, agent, resource)
+        p.set_cache(agent_cache)
+        p.get_file = self.get_blob
+        p.stat_file = self.stat_blob
+        p.upload_file = self.add_blob
+        p.run_sync = io_loop.run_sync
 
-            return p
-        except Exception as e:
-            raise e
+        return p
 
-        c.close_version(resource.id.version)
+    def finalize_context(self, ctx: "handler.HandlerContext"):
+        from inmanta.protocol import json_encode
+
+        # ensure logs can be serialized, skip this when the logs didn't change since the last check
+        if self._finalized_contexts.get(ctx) == len(ctx.logs):
+            return
 
-    def finalize_context(self, ctx: handler.HandlerContext):
-        # ensure logs can be serialized
-        json_encode({"message": ctx.logs})
+        serializable = False
+        if orjson is not None:
+            from inmanta.protocol.common import custom_json_encoder
+
+            # orjson may not accept more than json_encode: non-str keys are rejected and dataclasses, dates, times and
+            # subclasses of builtin types are passed to the encoder of the agent instead of being serialized natively
+            options = orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_SUBCLASS
+            # custom_json_encoder logs the values it can't serialize, this is left to json_encode so it's only logged once
+            encoder_logger = logging.getLogger(custom_json_encoder.__module__)
+            encoder_logger_disabled = encoder_logger.disabled
+            encoder_logger.disabled = True
+            try:
+                orjson.dumps({"message": ctx.logs}, default=custom_json_encoder, option=options)
+                serializable = True
+            except TypeError:
+                # orjson is stricter than json in some cases (e.g. integers over 64 bit), the encoder of the agent decides
+                pass
+            finally:
+                encoder_logger.disabled = encoder_logger_disabled
+
+        if not serializable:
+            json_encode({"message": ctx.logs})
+        self._finalized_contexts[ctx] = len(ctx.logs)
 
     def get_resource(self, resource_type: str, **filter_args: dict):
         """
@@ -248,19 +499,25 @@ class Project():
             first one is returned. If none match, None is returned.
         """
         def apply_filter(resource):
+            # resource attributes live in the instance dict, only fall back to getattr for anything else
+            attributes = vars(resource)
             for arg, value in filter_args.items():
-                if not hasattr(resource, arg):
-                    return False
+                current = attributes.get(arg, _MISSING)
+                if current is _MISSING:
+                    current = getattr(resource, arg, _MISSING)
 
-                if getattr(resource, arg) != value:
+                if current is _MISSING or current != value:
                     return False
 
             return True
 
-        for resource in self.resources.values():
-            if not resource.is_type(resource_type):
-                continue
+        # index the resources per type on first use, is_type is too expensive to evaluate for every lookup
+        if resource_type not in self._resources_by_type:
+            self._resources_by_type[resource_type] = [
+                resource for resource in self.resources.values() if resource.is_type(resource_type)
+            ]
 
+        for resource in self._resources_by_type[resource_type]:
             if not apply_filter(resource):
                 continue
 
@@ -272,12 +529,22 @@ class Project():
         """
             Deploy the given resource with a handler
         """
-        h = self.get_handler(resource, run_as_root)
+        from inmanta.agent import cache
+        from inmanta.agent import handler
 
-        assert h is not None
+        # the version is closed after the deploy, this also closes the io of the handler
+        c = cache.AgentCache()
+        c.open_version(resource.id.version)
+        try:
+            h = self.get_handler(resource, run_as_root, c)
+
+            assert h is not None
+
+            ctx = handler.HandlerContext(resource)
+            h.execute(ctx, resource, dry_run)
+        finally:
+            c.close_version(resource.id.version)
 
-        ctx = handler.HandlerContext(resource)
-        h.execute(ctx, resource, dry_run)
         self.finalize_context(ctx)
         return ctx
 
@@ -312,6 +579,8 @@ class Project():
         return ctx.changes
 
     def io(self, run_as_root=False):
+        from inmanta.agent import io as agent_io
+
         version = 1
         if run_as_root:
             ret = agent_io.get_io(None, "ssh://root@localhost", version)
@@ -321,50 +590,77 @@ class Project():
 
     def create_module(self, name, initcf="", initpy=""):
         module_dir = os.path.join(self._test_project_dir, "libs", name)
+        # fails when the module exists, libs/<module under test> links to the real module
         os.mkdir(module_dir)
-        os.mkdir(os.path.join(module_dir, "model"))
-        os.mkdir(os.path.join(module_dir, "files"))
-        os.mkdir(os.path.join(module_dir, "templates"))
-        os.mkdir(os.path.join(module_dir, "plugins"))
-
-        with open(os.path.join(module_dir, "model", "_init.cf"), "w+") as fd:
-            fd.write(initcf)
+        for sub_dir in ["model", "files", "templates", "plugins"]:
+            os.makedirs(os.path.join(module_dir, sub_dir), exist_ok=True)
 
-        with open(os.path.join(module_dir, "plugins", "__init__.py"), "w+") as fd:
-            fd.write(initpy)
-
-        with open(os.path.join(module_dir, "module.yml"), "w+") as fd:
-            fd.write("""name: unittest
+        Path(module_dir, "model", "_init.cf").write_text(initcf)
+        Path(module_dir, "plugins", "__init__.py").write_text(initpy)
+        Path(module_dir, "module.yml").write_text("""name: unittest
 version: 0.1
 license: Test License
             """)
 
-    def compile(self, main):
+    def compile(self, main, cache=None):
         """
             Compile the configuration model in main. This method will load all required modules.
+
+            When the compile cache is enabled (--compile_cache or cache=True), compiling the same model as the previous
+            compile again, with the same facts and without changes to the modules in the project, reuses the types, output
+            and a copy of the resources of that compile. Plugins that depend on anything else (environment variables, files
+            outside of the project, the time) should not be used with the cache.
         """
+        from inmanta import compiler
+        from inmanta import export
+        from inmanta import module
+
+        if cache is None:
+            cache = self._compile_cache
+
+        # reuse the result of the previous compile if it was for the same model against the same modules
+        key = _compile_cache_key(self._test_project_dir, main, self._facts) if cache else None
+        if key in _COMPILE_CACHE:
+            version, resources, types, exporter, file_store, stdout, stderr = _COMPILE_CACHE[key]
+
+            self._blobs.update(file_store)
+
+            self.version = version
+            self.resources = _copy_resources(resources)
+            self._resources_by_type = {}
+            self.types = types
+            self._exporter = exporter
+            self._stdout = stdout
+            self._stderr = stderr
+            return
+
         # write main.cf
         with open(os.path.join(self._test_project_dir, "main.cf"), "w+") as fd:
             fd.write(main)
 
-        # compile the model
-        test_project = module.Project(self._test_project_dir)
-        module.Project.set(test_project)
+        # the compile loads the handlers again, a cached result from before this compile would not match them
+        _COMPILE_CACHE.clear()
+
+        # compile the model, the inmanta project can not be reused: it caches the ast of main.cf and the namespaces it
+        # loaded, so it is only created when there is no cached result
+        with _file_lock(self._venv_lock):
+            test_project = module.Project(self._test_project_dir)
+            module.Project.set(test_project)
 
-        # flush io capture buffer
-        self._capsys.readouterr()
+            # flush io capture buffer, a cached result comes with its own output so this is only needed for a real compile
+            self._capsys.readouterr()
 
-        (types, scopes) = compiler.do_compile(refs={"facts": self._facts})
+            (types, scopes) = compiler.do_compile(refs={"facts": self._facts})
 
         exporter = export.Exporter()
 
         version, resources = exporter.run(types, scopes, no_commit=True)
 
-        for key, blob in exporter._file_store.items():
-            self.add_blob(key, blob)
+        self._blobs.update(exporter._file_store)
 
         self.version = version
         self.resources = resources
+        self._resources_by_type = {}
         self.types = types
         self._exporter = exporter
 
@@ -373,6 +669,13 @@ license: Test License
         self._stdout = captured.out
         self._stderr = captured.err
 
+        if cache:
+            # the compile can download modules into libs, so compute the key again to match the next lookup
+            key = _compile_cache_key(self._test_project_dir, main, self._facts)
+            _COMPILE_CACHE[key] = (
+                version, _copy_resources(resources), types, exporter, dict(exporter._file_store), captured.out, captured.err
+            )
+
     def get_stdout(self):
         return self._stdout
 
@@ -384,30 +687,21 @@ license: Test License
             This method can be used to register mock templates or files in the virtual "unittest" module.
         """
         dir_name = os.path.join(self._test_project_dir, "libs", "unittest", subdir)
-        if not os.path.exists(dir_name):
-            os.mkdir(dir_name)
+        os.makedirs(dir_name, exist_ok=True)
 
-        with open(os.path.join(dir_name, name), "w+") as fd:
-            fd.write(content)
+        Path(dir_name, name).write_text(content)
 
     def _load_plugins(self):
         module_dir, _ = get_module_info()
         plugin_dir = os.path.join(module_dir, "plugins")
         if not os.path.exists(plugin_dir):
-            return
+            return {}
         if not os.path.exists(os.path.join(plugin_dir, "__init__.py")):
             raise Exception("Plugins directory doesn't have a __init__.py file.")
-        result = {}
-        mod_name = os.path.basename(module_dir)
-        imp.load_package("inmanta_plugins." + mod_name, plugin_dir)
-        for py_file in glob.glob(os.path.join(plugin_dir, "*.py")):
-            sub_mod_path = "inmanta_plugins." + mod_name + "." + os.path.basename(py_file).split(".")[0]
-            imp.load_source(sub_mod_path, py_file)
-            sub_mod = importlib.import_module(sub_mod_path)
-            for k, v in sub_mod.__dict__.items():
-                if isinstance(v, types.FunctionType):
-                    result[k] = v
-        return result
+        mtime_ns = max(
+            os.stat(py_file).st_mtime_ns for py_file in glob.glob(os.path.join(plugin_dir, "**", "*.py"), recursive=True)
+        )
+        return _load_plugins(module_dir, mtime_ns)
 
     def get_plugin_function(self, function_name):
         if function_name not in self._plugins:
@@ -415,9 +709,14 @@ license: Test License
         return self._plugins[function_name]
 
     def get_plugins(self):
-        return dict(self._plugins)
+        """
+            Return a read-only mapping of all plugin functions by name, use dict() on it to get a modifiable copy
+        """
+        return types.MappingProxyType(self._plugins)
 
     def get_instances(self, fortype: str="std::Entity"):
+        from inmanta.execute.proxy import DynamicProxy
+
         # extract all objects of a specific type from the compiler
         allof = self.types[fortype].get_all_instances()
         # wrap in DynamicProxy to hide internal compiler structure
@@ -34,6 +34,9 @@ setup(
     keywords=('pytest py.test inmanta testing unit tests plugin'),
     packages=find_packages(),
     install_requires=['pytest', 'inmanta'],
+    extras_require={
+        'orjson': ['orjson'],
+    },
     entry_points={
         'pytest11': ['inmanta = pytest_inmanta.plugin'],
     },
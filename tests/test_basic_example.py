@@ -1,3 +1,7 @@
+import os
+
+import pytest
+import pytest_inmanta.plugin
 
 
 def test_basic_example(testdir):
@@ -58,11 +62,60 @@ def test_fixture_reset(testdir):
     result.assert_outcomes(passed=2)
 
 
-def test_badlog(testdir):
-    """Make sure that the run_sync mock works."""
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_badlog(testdir, monkeypatch, use_orjson):
+    """Make sure that logs that can't be serialized fail the deploy, with and without orjson."""
+
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(pytest_inmanta.plugin, "orjson", None)
 
     testdir.copy_example("testmodule")
 
     result = testdir.runpytest("tests/test_BadLog.py")
 
-    result.assert_outcomes(failed=1)
\ No newline at end of file
+    result.assert_outcomes(failed=1)
+
+
+def test_compile_cache(testdir):
+    """Make sure that the compile cache reuses results and doesn't leak changes between tests."""
+
+    testdir.copy_example("testmodule")
+
+    result = testdir.runpytest("tests/test_compile_cache.py", "--compile_cache")
+
+    result.assert_outcomes(passed=4)
+
+
+def test_xdist(testdir):
+    """Make sure that the tests can run in parallel with pytest-xdist."""
+    pytest.importorskip("xdist")
+
+    testdir.copy_example("testmodule")
+
+    result = testdir.runpytest("tests/test_stuff.py", "tests/test_dryrun.py", "-n", "2")
+
+    result.assert_outcomes(passed=2)
+
+
+def test_deploy_multiple(testdir):
+    """Make sure that a handler can be used for several resources of the same type."""
+
+    testdir.copy_example("testmodule")
+
+    result = testdir.runpytest("tests/test_deploy_multiple.py")
+
+    result.assert_outcomes(passed=1)
+
+
+def test_run_from_subdirectory(testdir):
+    """Make sure that the module is found when pytest runs in a sub directory of the module."""
+
+    testdir.copy_example("testmodule")
+    testdir.tmpdir.join("tests").chdir()
+    pytest_inmanta.plugin.CURDIR = os.getcwd()
+
+    result = testdir.runpytest("test_stuff.py")
+
+    result.assert_outcomes(passed=1)